@@ -4,12 +4,20 @@ import time
 import random
 import numpy as np
 import tensorflow as tf
-from skimage.color import rgb2gray
-from skimage.transform import resize
+from numba import njit
+from scipy.signal import lfilter
+from threading import Thread
+from threading import Event
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from network import A3CFF
 
 from constant import ENV_NAME
+from constant import NUM_THREADS
 from constant import FRAME_WIDTH
 from constant import FRAME_HEIGHT
 from constant import STATE_LENGTH
@@ -22,12 +30,91 @@ from constant import SAVE_INTERVAL
 from constant import SAVE_NETWORK_PATH
 from constant import LOG_INTERVAL
 from constant import CLIP_NORM
+from constant import GRAD_ACCUM_STEPS
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def fused_preprocess(observation, last_observation, out):
+    # Max over two frames, grayscale conversion and area-averaged resize in a single pass over the frames.
+    # Runs without the GIL so that other actor-learner threads can step their environments meanwhile
+    in_h = observation.shape[0]
+    in_w = observation.shape[1]
+    out_h = out.shape[0]
+    out_w = out.shape[1]
+    scale_y = float(in_h) / out_h
+    scale_x = float(in_w) / out_w
+    norm = 1.0 / (scale_y * scale_x)
+
+    for i in range(out_h):
+        y0 = i * scale_y
+        y1 = y0 + scale_y
+        for j in range(out_w):
+            x0 = j * scale_x
+            x1 = x0 + scale_x
+            acc = 0.0
+            for y in range(int(y0), min(int(np.ceil(y1)), in_h)):
+                # Fraction of source row y covered by the output pixel
+                wy = min(y + 1.0, y1) - max(float(y), y0)
+                for x in range(int(x0), min(int(np.ceil(x1)), in_w)):
+                    wx = min(x + 1.0, x1) - max(float(x), x0)
+                    r = max(observation[y, x, 0], last_observation[y, x, 0])
+                    g = max(observation[y, x, 1], last_observation[y, x, 1])
+                    b = max(observation[y, x, 2], last_observation[y, x, 2])
+                    acc += wy * wx * (0.2125 * r + 0.7154 * g + 0.0721 * b)
+            # Round to the nearest uint8 level
+            out[i, j] = acc * norm + 0.5
+
+
+class InferenceServer(object):
+    def __init__(self, network):
+        self.network = network
+        self.requests = queue.Queue()
+
+    def start(self, sess):
+        thread = Thread(target=self.serve, args=(sess,))
+        thread.daemon = True
+        thread.start()
+
+    def infer(self, state):
+        # Block the calling actor-learner thread until its request has been served
+        done = Event()
+        result = [None]
+        self.requests.put((state, done, result))
+        done.wait()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def serve(self, sess):
+        while True:
+            batch = [self.requests.get()]
+            # Serve every request that is already waiting in the same sess.run
+            while len(batch) < NUM_THREADS:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            states = np.stack([state for state, _, _ in batch])
+            try:
+                pi_out, v_out = sess.run([self.network.pi, self.network.v], feed_dict={self.network.s: states})
+            except Exception as e:
+                # Hand the error to the waiting threads instead of leaving them blocked on a dead server
+                for _, done, result in batch:
+                    result[0] = e
+                    done.set()
+                continue
+
+            for i, (_, done, result) in enumerate(batch):
+                result[0] = (pi_out[i], v_out[i][0])
+                done.set()
 
 
 class Agent(object):
-    def __init__(self, thread_id, num_actions, global_network, lr_input, optimizer):
+    def __init__(self, thread_id, num_actions, global_network, lr_input, optimizer, inference_server=None):
         self.thread_id = thread_id
         self.lr_input = lr_input
+        self.inference_server = inference_server
 
         self.local_network = A3CFF(num_actions)
         self.local_network.build_training_op()
@@ -35,46 +122,78 @@ class Agent(object):
         get_grads = tf.gradients(self.local_network.loss, self.local_network.get_vars())
         for i, grad in enumerate(get_grads):
             get_grads[i] = tf.clip_by_norm(grad, CLIP_NORM)
-        grads_and_vars = zip(get_grads, global_network.get_vars())
-        self.grads_update = optimizer.apply_gradients(grads_and_vars)
+
+        if GRAD_ACCUM_STEPS == 1:
+            grads_and_vars = zip(get_grads, global_network.get_vars())
+            self.grads_update = optimizer.apply_gradients(grads_and_vars)
+            self.grads_apply = self.grads_update
+        else:
+            # Average the gradients of GRAD_ACCUM_STEPS rollouts and apply them to the global network at once
+            accum_grads = [tf.Variable(tf.zeros(var.get_shape()), trainable=False) for var in global_network.get_vars()]
+            accum_op = [accum_grad.assign_add(grad / GRAD_ACCUM_STEPS, use_locking=False) for accum_grad, grad in zip(accum_grads, get_grads)]
+            self.grads_update = tf.group(*accum_op)
+
+            with tf.control_dependencies(accum_op):
+                apply_op = optimizer.apply_gradients(zip(accum_op, global_network.get_vars()))
+            with tf.control_dependencies([apply_op]):
+                reset_op = [accum_grad.assign(tf.zeros_like(accum_grad), use_locking=False) for accum_grad in accum_grads]
+            self.grads_apply = tf.group(*reset_op)
+        self.num_rollouts = 0
+
+        # Policy of the last bootstrap state, which is also the first state of the next rollout
+        self.next_pi = None
 
         self.sync_op = self.local_network.sync_with(global_network)
 
+        # Reused by every preprocess call of this thread
+        self.frame = np.empty((FRAME_WIDTH, FRAME_HEIGHT), dtype=np.uint8)
+
     def get_initial_state(self, observation, last_observation):
-        processed_observation = np.maximum(observation, last_observation)
-        processed_observation = resize(rgb2gray(processed_observation), (FRAME_WIDTH, FRAME_HEIGHT))
-        state = [processed_observation for _ in range(STATE_LENGTH)]
-        return np.stack(state, axis=2)
+        processed_observation = self.preprocess(observation, last_observation)
+        # Copied once, since the state is used as a writable frame ring
+        return np.broadcast_to(processed_observation[:, :, np.newaxis], (FRAME_WIDTH, FRAME_HEIGHT, STATE_LENGTH)).copy()
 
     def get_action(self, sess, state, local_t):
-        pi = self.local_network.get_pi(sess, state)
-
-        # Subtract a tiny value from probabilities in order to avoid 'ValueError: sum(pvals[:-1]) > 1.0' in np.random.multinomial
-        pi = pi - np.finfo(np.float32).epsneg
+        if self.next_pi is not None:
+            pi = self.next_pi
+            self.next_pi = None
+        elif self.inference_server is not None:
+            pi, _ = self.inference_server.infer(state)
+        else:
+            pi = self.local_network.get_pi(sess, state)
 
-        histogram = np.random.multinomial(1, pi)
-        action = int(np.nonzero(histogram)[0])
+        # Inverse transform sampling; scaling by the total makes it robust to pi not summing exactly to 1.
+        # Accumulate in float64 so the draw is not rounded up to the total, and clamp in case it still is
+        cumulative_pi = np.cumsum(pi, dtype=np.float64)
+        action = int(np.searchsorted(cumulative_pi, np.random.random() * cumulative_pi[-1], side='right'))
+        action = min(action, len(pi) - 1)
 
         return action
 
     def preprocess(self, observation, last_observation):
-        processed_observation = np.maximum(observation, last_observation)
-        processed_observation = resize(rgb2gray(processed_observation), (FRAME_WIDTH, FRAME_HEIGHT))
-        return np.reshape(processed_observation, (FRAME_WIDTH, FRAME_HEIGHT, 1))
+        fused_preprocess(observation, last_observation, self.frame)
+        return self.frame
 
     def run(self, sess, state, terminal, state_batch, action_batch, reward_batch, learning_rate, local_t, local_t_start):
         if terminal:
             r = 0
+        elif self.inference_server is not None:
+            self.next_pi, r = self.inference_server.infer(state)
         else:
-            r = self.local_network.get_v(sess, state)
+            # Fetch pi together with v so that the next action does not need another forward pass
+            self.next_pi, r = self.local_network.get_pi_and_v(sess, state)
 
-        r_batch = np.zeros(local_t - local_t_start)
+        # Discounted returns r_i = reward_i + GAMMA * r_(i+1), bootstrapped from r, computed by a single IIR filter over the reversed rewards
+        r_batch, _ = lfilter([1.0], [1.0, -GAMMA], reward_batch[::-1], zi=[GAMMA * r])
+        r_batch = r_batch[::-1]
 
-        for i in reversed(range(local_t_start, local_t)):
-            r = reward_batch[i - local_t_start] + GAMMA * r
-            r_batch[i - local_t_start] = r
+        self.num_rollouts += 1
+        if self.num_rollouts % GRAD_ACCUM_STEPS == 0:
+            grads_op = self.grads_apply
+        else:
+            grads_op = self.grads_update
 
-        loss, _ = sess.run([self.local_network.loss, self.grads_update], feed_dict={
+        loss, _ = sess.run([self.local_network.loss, grads_op], feed_dict={
             self.local_network.s: state_batch,
             self.local_network.a: action_batch,
             self.local_network.r: r_batch,
@@ -87,8 +206,8 @@ class Agent(object):
         save_path = saver.save(sess, SAVE_NETWORK_PATH + '/' + ENV_NAME, global_step=global_t)
         print('Successfully saved: ' + save_path)
 
-    def write_summary(self, sess, total_reward, duration, global_episode, total_loss, summary_placeholders, update_ops, summary_op, summary_writer):
-        stats = [total_reward, duration, sum(total_loss) / len(total_loss)]
+    def write_summary(self, sess, total_reward, duration, global_episode, avg_loss, summary_placeholders, update_ops, summary_op, summary_writer):
+        stats = [total_reward, duration, avg_loss]
         for i in range(len(stats)):
             sess.run(update_ops[i], feed_dict={
                 summary_placeholders[i]: float(stats[i])
@@ -104,7 +223,8 @@ class Agent(object):
         lr_step = INITIAL_LEARNING_RATE / GLOBAL_T_MAX
 
         total_reward = 0
-        total_loss = []
+        total_loss = 0.0
+        num_losses = 0
         duration = 0
         global_episode = 0
         local_episode = 0
@@ -112,6 +232,14 @@ class Agent(object):
         pre_global_t_save = 0
         pre_global_t_log = 0
 
+        # The state is kept as a ring of uint8 frames, frame_ring[:, :, head] being the oldest one
+        ring_order = [[(head + i) % STATE_LENGTH for i in range(STATE_LENGTH)] for head in range(STATE_LENGTH)]
+
+        # Rollout buffers reused by every rollout of this thread
+        state_batch = np.empty((LOCAL_T_MAX, FRAME_WIDTH, FRAME_HEIGHT, STATE_LENGTH), dtype=np.uint8)
+        action_batch = np.empty(LOCAL_T_MAX, dtype=np.int32)
+        reward_batch = np.empty(LOCAL_T_MAX, dtype=np.float32)
+
         start_time = time.time()
 
         terminal = False
@@ -119,36 +247,34 @@ class Agent(object):
         for _ in range(random.randint(1, NO_OP_STEPS)):
             last_observation = observation
             observation, _, _, _ = env.step(0)  # Do nothing
-        state = self.get_initial_state(observation, last_observation)
+        frame_ring = self.get_initial_state(observation, last_observation)
+        head = 0
 
         while global_t < GLOBAL_T_MAX:
             local_t_start = local_t
 
-            state_batch = []
-            action_batch = []
-            reward_batch = []
-
             sess.run(self.sync_op)
 
             while not (terminal or ((local_t - local_t_start) == LOCAL_T_MAX)):
                 last_observation = observation
+                i = local_t - local_t_start
 
+                # Gathered straight into the rollout buffer; mode='clip' lets np.take write to out without buffering
+                state = np.take(frame_ring, ring_order[head], axis=2, out=state_batch[i], mode='clip')
                 action = self.get_action(sess, state, local_t)
 
                 observation, reward, terminal, _ = env.step(action)
 
-                state_batch.append(state)
-                action_batch.append(action)
-                reward = np.clip(reward, -1, 1)
-                reward_batch.append(reward)
+                action_batch[i] = action
+                reward_batch[i] = reward
 
-                processed_observation = self.preprocess(observation, last_observation)
-                next_state = np.append(state[:, :, 1:], processed_observation, axis=2)
+                # Overwrite the oldest frame
+                frame_ring[:, :, head] = self.preprocess(observation, last_observation)
+                head = (head + 1) % STATE_LENGTH
 
                 local_t += 1
                 global_t += 1
 
-                total_reward += reward
                 duration += 1
 
                 # Anneal learning rate linearly over time
@@ -156,22 +282,29 @@ class Agent(object):
                 if learning_rate < 0.0:
                     learning_rate = 0.0
 
-                state = next_state
+            n = local_t - local_t_start
+            np.clip(reward_batch[:n], -1, 1, out=reward_batch[:n])
+            total_reward += np.sum(reward_batch[:n])
 
-            loss = self.run(sess, state, terminal, state_batch, action_batch, reward_batch, learning_rate, local_t, local_t_start)
-            total_loss.append(loss)
+            state = np.take(frame_ring, ring_order[head], axis=2)
+            loss = self.run(sess, state, terminal, state_batch[:n], action_batch[:n], reward_batch[:n], learning_rate, local_t, local_t_start)
+            total_loss += float(loss)
+            num_losses += 1
 
             if terminal:
+                avg_loss = total_loss / num_losses
+
                 if self.thread_id == 0:
                     # Write summary
-                    self.write_summary(sess, total_reward, duration, global_episode, total_loss, summary_placeholders, update_ops, summary_op, summary_writer)
+                    self.write_summary(sess, total_reward, duration, global_episode, avg_loss, summary_placeholders, update_ops, summary_op, summary_writer)
 
                 # Debug
                 print('THREAD: {0:2d} / GLOBAL_EPISODE: {1:6d} / GLOBAL_TIME: {2:10d} / LOCAL_EPISODE: {3:4d} / LOCAL_TIME: {4:8d} / DURATION: {5:5d} / TOTAL_REWARD: {6:3.0f} / AVG_LOSS: {7:.5f} / LEARNING_RATE: {8:.10f}'.format(
-                    self.thread_id, global_episode + 1, global_t, local_episode + 1, local_t, duration, total_reward, sum(total_loss) / len(total_loss), learning_rate))
+                    self.thread_id, global_episode + 1, global_t, local_episode + 1, local_t, duration, total_reward, avg_loss, learning_rate))
 
                 total_reward = 0
-                total_loss = []
+                total_loss = 0.0
+                num_losses = 0
                 duration = 0
                 local_episode += 1
                 global_episode += 1
@@ -181,7 +314,8 @@ class Agent(object):
                 for _ in range(random.randint(1, NO_OP_STEPS)):
                     last_observation = observation
                     observation, _, _, _ = env.step(0)  # Do nothing
-                state = self.get_initial_state(observation, last_observation)
+                frame_ring = self.get_initial_state(observation, last_observation)
+                head = 0
 
             # Save network
             if (self.thread_id == 0) and (global_t - pre_global_t_save >= SAVE_INTERVAL):
@@ -2,6 +2,7 @@
 
 ENV_NAME = 'Breakout-v0'
 NUM_THREADS = 8
+ENV_PROCESS = False  # Step each environment in its own process
 FRAME_WIDTH = 84
 FRAME_HEIGHT = 84
 STATE_LENGTH = 4
@@ -14,9 +15,13 @@ RMSP_ALPHA = 0.99
 RMSP_EPSILON = 0.1
 NO_OP_STEPS = 30
 CLIP_NORM = 40
+GRAD_ACCUM_STEPS = 1
+DATA_FORMAT = 'NHWC'  # 'NHWC' for CPU, 'NCHW' for GPU
 SAVE_INTERVAL = 500000
 LOG_INTERVAL = 10000
 SAVE_NETWORK_PATH = 'saved_networks/' + ENV_NAME
 SAVE_SUMMARY_PATH = 'summary/' + ENV_NAME
 LOAD_NETWORK = False
 DISPLAY = False
+DISPLAY_FPS = 30
+BATCH_INFERENCE = False
@@ -0,0 +1,68 @@
+# coding:utf-8
+
+import gym
+from multiprocessing import Pipe
+from multiprocessing import Process
+from threading import Lock
+
+
+def env_worker(env_name, conn):
+    env = gym.make(env_name)
+    conn.send(env.action_space)
+
+    while True:
+        command, data = conn.recv()
+        if command == 'close':
+            env.close()
+            conn.close()
+            break
+
+        # Errors are sent back and re-raised in the parent, which would otherwise block in recv forever
+        try:
+            if command == 'step':
+                conn.send(env.step(data))
+            elif command == 'reset':
+                conn.send(env.reset())
+            elif command == 'render':
+                conn.send(env.render())
+            else:
+                raise ValueError('Unknown command: ' + str(command))
+        except Exception as e:
+            conn.send(e)
+
+
+class ProcessEnv(object):
+    # Runs a gym environment in its own process and forwards calls to it over a pipe
+    def __init__(self, env_name):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=env_worker, args=(env_name, child_conn))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        # The main thread may render while an actor-learner thread steps the same environment
+        self.lock = Lock()
+
+        self.action_space = self.conn.recv()
+
+    def call(self, command, data=None):
+        with self.lock:
+            self.conn.send((command, data))
+            result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def step(self, action):
+        return self.call('step', action)
+
+    def reset(self):
+        return self.call('reset')
+
+    def render(self):
+        return self.call('render')
+
+    def close(self):
+        with self.lock:
+            self.conn.send(('close', None))
+        self.process.join()
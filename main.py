@@ -1,12 +1,15 @@
 # coding:utf-8
 
 import os
+import time
 import gym
 import tensorflow as tf
 from threading import Thread
 
 from network import A3CFF
 from agent import Agent
+from agent import InferenceServer
+from environment import ProcessEnv
 
 from constant import ENV_NAME
 from constant import NUM_THREADS
@@ -16,6 +19,9 @@ from constant import SAVE_NETWORK_PATH
 from constant import SAVE_SUMMARY_PATH
 from constant import LOAD_NETWORK
 from constant import DISPLAY
+from constant import DISPLAY_FPS
+from constant import BATCH_INFERENCE
+from constant import ENV_PROCESS
 
 
 def load_network(sess, saver):
@@ -42,15 +48,23 @@ def setup_summary():
 
 
 def main():
-    envs = [gym.make(ENV_NAME) for _ in range(NUM_THREADS)]
+    # Environments are created before the session so that their processes are forked from a clean state
+    if ENV_PROCESS:
+        envs = [ProcessEnv(ENV_NAME) for _ in range(NUM_THREADS)]
+    else:
+        envs = [gym.make(ENV_NAME) for _ in range(NUM_THREADS)]
 
     num_actions = envs[0].action_space.n
     global_network = A3CFF(num_actions)
 
     lr_input = tf.placeholder(tf.float32)
-    optimizer = tf.train.RMSPropOptimizer(lr_input, decay=RMSP_ALPHA, epsilon=RMSP_EPSILON)
+    # Hogwild-style: threads update the shared variables and RMSProp slots without locking
+    optimizer = tf.train.RMSPropOptimizer(lr_input, decay=RMSP_ALPHA, epsilon=RMSP_EPSILON, use_locking=False)
+
+    # Serve the actions of all threads from the global network in batched forward passes
+    inference_server = InferenceServer(global_network) if BATCH_INFERENCE else None
 
-    agents = [Agent(i, num_actions, global_network, lr_input, optimizer) for i in range(NUM_THREADS)]
+    agents = [Agent(i, num_actions, global_network, lr_input, optimizer, inference_server) for i in range(NUM_THREADS)]
 
     sess = tf.InteractiveSession()
     saver = tf.train.Saver(global_network.get_vars())
@@ -65,6 +79,9 @@ def main():
     if LOAD_NETWORK:
         load_network(sess, saver)
 
+    if inference_server is not None:
+        inference_server.start(sess)
+
     actor_learner_threads = []
     for i in range(NUM_THREADS):
         env = envs[i]
@@ -74,13 +91,18 @@ def main():
     for thread in actor_learner_threads:
         thread.start()
 
-    while DISPLAY:
+    # Render at a capped frame rate so that the main thread does not compete with the actor-learner threads for the GIL
+    while DISPLAY and any(thread.is_alive() for thread in actor_learner_threads):
         for env in envs:
             env.render()
+        time.sleep(1.0 / DISPLAY_FPS)
 
     for thread in actor_learner_threads:
         thread.join()
 
+    for env in envs:
+        env.close()
+
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,7 @@ from constant import FRAME_WIDTH
 from constant import FRAME_HEIGHT
 from constant import STATE_LENGTH
 from constant import ENTROPY_BETA
+from constant import DATA_FORMAT
 
 
 class Network(object):
@@ -17,17 +18,15 @@ class Network(object):
         self.a = tf.placeholder(tf.int32, [None])
         self.r = tf.placeholder(tf.float32, [None])
 
-        # Convert action to one hot vector
-        a_one_hot = tf.one_hot(self.a, self.num_actions, 1.0, 0.0)
+        # Pick log pi(a|s) of the taken actions directly from the flattened batch
+        a_indices = tf.range(tf.shape(self.a)[0]) * self.num_actions + self.a
+        log_pi_a = tf.gather(tf.reshape(self.log_pi, [-1]), a_indices)
 
-        # Avoid NaN by clipping pi when its values become zero
-        log_pi = tf.log(tf.clip_by_value(self.pi, 1e-20, 1.0))
-
-        entropy = -tf.reduce_sum(self.pi * log_pi, reduction_indices=1)
+        entropy = -tf.reduce_sum(self.pi * self.log_pi, reduction_indices=1)
 
         advantage = self.r - self.v
 
-        p_loss = -(tf.reduce_sum(tf.mul(log_pi, a_one_hot), reduction_indices=1) * advantage + ENTROPY_BETA * entropy)
+        p_loss = -(log_pi_a * advantage + ENTROPY_BETA * entropy)
         v_loss = tf.square(advantage)
         self.loss = tf.reduce_mean(p_loss + 0.5 * v_loss)
 
@@ -37,7 +36,7 @@ class Network(object):
 
         sync_op = []
         for src_var, dst_var in zip(src_vars, dst_vars):
-            sync_op.append(tf.assign(dst_var, src_var))
+            sync_op.append(tf.assign(dst_var, src_var, use_locking=False))
 
         return sync_op
 
@@ -65,8 +64,13 @@ class Network(object):
         initial = tf.random_uniform(shape, minval=-d, maxval=d)
         return tf.Variable(initial)
 
-    def conv2d(self, x, W, stride):
-        return tf.nn.conv2d(x, W, strides=[1, stride, stride, 1], padding='VALID')
+    def conv2d(self, x, W, b, stride):
+        if DATA_FORMAT == 'NCHW':
+            strides = [1, 1, stride, stride]
+        else:
+            strides = [1, stride, stride, 1]
+        h = tf.nn.conv2d(x, W, strides=strides, padding='VALID', data_format=DATA_FORMAT)
+        return tf.nn.bias_add(h, b, data_format=DATA_FORMAT)
 
 
 class A3CFF(Network):
@@ -88,24 +92,34 @@ class A3CFF(Network):
         self.W_fc3 = self.fc_weight_variable([256, 1])
         self.b_fc3 = self.fc_bias_variable([1], 256)
 
-        self.s = tf.placeholder(tf.float32, [None, FRAME_WIDTH, FRAME_HEIGHT, STATE_LENGTH])
+        # States are fed as uint8 frames and scaled to [0, 1] inside the graph
+        self.s = tf.placeholder(tf.uint8, [None, FRAME_WIDTH, FRAME_HEIGHT, STATE_LENGTH])
+        s = tf.cast(self.s, tf.float32) * (1.0 / 255.0)
+
+        # States are always fed channels last; convert them once so that the conv kernels run in their native layout
+        if DATA_FORMAT == 'NCHW':
+            s = tf.transpose(s, [0, 3, 1, 2])
 
-        h_conv1 = tf.nn.relu(self.conv2d(self.s, self.W_conv1, 4) + self.b_conv1)
-        h_conv2 = tf.nn.relu(self.conv2d(h_conv1, self.W_conv2, 2) + self.b_conv2)
+        h_conv1 = tf.nn.relu(self.conv2d(s, self.W_conv1, self.b_conv1, 4))
+        h_conv2 = tf.nn.relu(self.conv2d(h_conv1, self.W_conv2, self.b_conv2, 2))
 
         h_conv2_flat = tf.reshape(h_conv2, [-1, 2592])
         h_fc1 = tf.nn.relu(tf.matmul(h_conv2_flat, self.W_fc1) + self.b_fc1)
 
-        self.pi = tf.nn.softmax(tf.matmul(h_fc1, self.W_fc2) + self.b_fc2)
+        logits = tf.matmul(h_fc1, self.W_fc2) + self.b_fc2
+        self.pi = tf.nn.softmax(logits)
+        # Computed from the logits, so zero probabilities no longer have to be clipped to avoid NaN
+        self.log_pi = tf.nn.log_softmax(logits)
         self.v = tf.matmul(h_fc1, self.W_fc3) + self.b_fc3
 
     def get_pi(self, sess, state):
-        pi_out = sess.run(self.pi, feed_dict={self.s: [state]})
+        # Feed a batch-of-one view rather than a list, which would make the feed convert it element by element
+        pi_out = sess.run(self.pi, feed_dict={self.s: state[np.newaxis]})
         return pi_out[0]
 
-    def get_v(self, sess, state):
-        v_out = sess.run(self.v, feed_dict={self.s: [state]})
-        return v_out[0][0]
+    def get_pi_and_v(self, sess, state):
+        pi_out, v_out = sess.run([self.pi, self.v], feed_dict={self.s: state[np.newaxis]})
+        return pi_out[0], v_out[0][0]
 
     def get_vars(self):
         return [self.W_conv1, self.b_conv1, self.W_conv2, self.b_conv2, self.W_fc1, self.b_fc1, self.W_fc2, self.b_fc2, self.W_fc3, self.b_fc3]